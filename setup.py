@@ -1,4 +1,13 @@
-from setuptools import setup
+from setuptools import Extension, setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    # The extension only speeds things up, so build without it.
+    ext_modules = []
+else:
+    ext_modules = cythonize(
+        [Extension('vidua._bps_fast', ['vidua/_bps_fast.pyx'], optional=True)])
 
 with open('README.md', 'r') as fh:
     long_description = fh.read()
@@ -18,6 +27,7 @@ setup(name='vidua',
           'Topic :: Utilities',
       ],
       packages=['vidua'],
+      ext_modules=ext_modules,
       package_data={
         'vidua': ['py.typed'],
       },
@@ -26,6 +36,9 @@ setup(name='vidua',
             'vidua = vidua.scripts:main',
         ],
       },
+      extras_require={
+        'fast': ['fastcrc'],
+      },
       setup_requires=['setuptools_scm', 'pytest-runner'],
       tests_require=['pytest'],
       use_scm_version=True,
@@ -0,0 +1,56 @@
+# cython: language_level=3
+"""Compiled versions of the hot parts of :mod:`vidua.bps`.
+
+This module is optional: :mod:`vidua.bps` uses it when it has been built and
+falls back to the pure-Python code otherwise, so everything here must behave
+exactly like its Python counterpart.
+"""
+
+
+cpdef tuple decode_number(const unsigned char[::1] buf, Py_ssize_t pos, Py_ssize_t end):
+    """Decode the number at ``pos`` in ``buf``.
+
+    Return a tuple of the decoded number and the position just past it.
+
+    :param buf: the contents of the patch file
+    :param pos: the offset of the number in ``buf``
+    :param end: the last offset the number may use (normally the start of the
+        checksums, ``len(buf) - 12``)
+    """
+    cdef unsigned long long data
+    cdef unsigned long long shift
+    cdef unsigned char x
+    cdef Py_ssize_t count
+
+    if pos > end:
+        raise ValueError("Invalid number encoding.")
+    x = buf[pos]
+    pos += 1
+    if x & 0x80:
+        return x & 0x7f, pos
+
+    # No number in a valid patch needs more than ten bytes (enough for 64
+    # bits), so give up there rather than decoding a run of junk bytes.
+    end = min(end, pos + 8)
+    data = x
+    shift = 1
+    # Nine bytes always fit in 64 bits; only a tenth can overflow.
+    for count in range(8):
+        shift <<= 7
+        data += shift
+        if pos > end:
+            raise ValueError("Invalid number encoding.")
+        x = buf[pos]
+        pos += 1
+        data += (x & 0x7f) * shift
+        if x & 0x80:
+            return data, pos
+
+    if pos > end:
+        raise ValueError("Invalid number encoding.")
+    x = buf[pos]
+    pos += 1
+    if not x & 0x80:
+        raise ValueError("Invalid number encoding.")
+    big_shift = <object>shift << 7
+    return <object>data + big_shift + (x & 0x7f) * big_shift, pos
@@ -1,36 +1,54 @@
 """Validate and apply BPS patches."""
 import logging
-import zlib
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import BinaryIO
+from typing import BinaryIO, List, Optional, Tuple, Union
 
-from .util import copy_bytes
+from .util import crc32, crc32_bytes, mapped
 
 logger = logging.getLogger(__name__)
 
 
-def decode_number(bps_patch: BinaryIO) -> int:
-    """Return the next number in ``bps_patch``.
+def _decode_number_py(buf: bytes, pos: int, end: int) -> Tuple[int, int]:
+    """Decode the number at ``pos`` in ``buf``.
 
-    :param bps_patch: the patch file
+    Return a tuple of the decoded number and the position just past it.
+
+    :param buf: the contents of the patch file
+    :param pos: the offset of the number in ``buf``
+    :param end: the last offset the number may use (normally the start of the
+        checksums, ``len(buf) - 12``)
     """
-    data = 0
+    if pos > end:
+        raise ValueError("Invalid number encoding.")
+    x = buf[pos]
+    pos += 1
+    # Most numbers in a patch (command words especially) fit in one byte.
+    if x & 0x80:
+        return x & 0x7f, pos
+
+    # No number in a valid patch needs more than ten bytes (enough for 64
+    # bits), so give up there rather than decoding a run of junk bytes.
+    end = min(end, pos + 8)
+    data = x
     shift = 1
     while True:
-        pos = bps_patch.tell()
-        end = bps_patch.seek(0, 2)
-        if pos > end - 12:
+        shift <<= 7
+        data += shift
+        if pos > end:
             raise ValueError("Invalid number encoding.")
-        bps_patch.seek(pos)
-        x = bps_patch.read(1)
-        x = ord(x)
+        x = buf[pos]
+        pos += 1
         data += (x & 0x7f) * shift
-        if (x & 0x80):
-            break
-        else:
-            shift <<= 7
-            data += shift
-    return data
+        if x & 0x80:
+            return data, pos
+
+
+try:
+    from ._bps_fast import decode_number
+except ImportError:
+    decode_number = _decode_number_py
 
 
 def patch_info(bps_patch: BinaryIO) -> dict:
@@ -46,140 +64,216 @@ def patch_info(bps_patch: BinaryIO) -> dict:
     :param bps_patch: the patch file
     """
     info = {}
-    bps_patch.seek(4)
-    info['source_size'] = decode_number(bps_patch)
-    info['target_size'] = decode_number(bps_patch)
-    metadata_size = decode_number(bps_patch)
-    info['metadata'] = bps_patch.read(metadata_size)
-    bps_patch.seek(-12, 2)
-    info['source_checksum'] = int.from_bytes(bps_patch.read(4), byteorder='little')
-    info['target_checksum'] = int.from_bytes(bps_patch.read(4), byteorder='little')
+    bps_patch.seek(0)
+    buf = bps_patch.read()
+    end = len(buf) - 12
+    info['source_size'], pos = decode_number(buf, 4, end)
+    info['target_size'], pos = decode_number(buf, pos, end)
+    metadata_size, pos = decode_number(buf, pos, end)
+    info['metadata'] = buf[pos:pos + metadata_size]
+    info['source_checksum'] = int.from_bytes(buf[-12:-8], byteorder='little')
+    info['target_checksum'] = int.from_bytes(buf[-8:-4], byteorder='little')
     bps_patch.seek(0)
     return info
 
 
-def validate_patch(bps_patch: BinaryIO):
-    """Verify that ``bps_patch`` is a valid BPS patch.
+def _read_header(buf: bytes) -> Tuple[int, int, int]:
+    """Check the patch-level structure of ``buf``.
 
-    If the patch is valid, return. If the patch is invalid, raise a
-    ``ValueError`` describing the problem.
+    Return a tuple of the source size, the target size, and the offset of the
+    first command. Raise a ``ValueError`` if the patch is invalid.
 
-    :param bps_patch: the patch file
+    :param buf: the contents of the patch file
     """
-    bps_patch.seek(0)
-    if bps_patch.read(4) != b'BPS1':
+    if buf[:4] != b'BPS1':
         raise ValueError("Invalid file format marker.")
 
-    patch_end = bps_patch.seek(0, 2)
+    patch_end = len(buf)
     if patch_end < 19:
         raise ValueError("Patch too short.")
 
-    bps_patch.seek(0)
-    calculated_checksum = zlib.crc32(bps_patch.read(patch_end - 4))
-    checksum = int.from_bytes(bps_patch.read(4), byteorder='little')
+    calculated_checksum = crc32_bytes(memoryview(buf)[:-4])
+    checksum = int.from_bytes(buf[-4:], byteorder='little')
     if calculated_checksum != checksum:
         raise ValueError("Invalid checksum. Stored checksum {:X}, actual checksum {:X}.".format(
             checksum, calculated_checksum))
 
-    bps_patch.seek(4)
+    end_cmd = patch_end - 12
 
     try:
-        source_size = decode_number(bps_patch)
+        source_size, pos = decode_number(buf, 4, end_cmd)
         logger.debug("Source size: 0x%x", source_size)
     except ValueError:
         raise ValueError("Failed to decode source size.")
 
     try:
-        target_size = decode_number(bps_patch)
+        target_size, pos = decode_number(buf, pos, end_cmd)
         logger.debug("Target size: 0x%x", target_size)
     except ValueError:
         raise ValueError("Failed to decode target size.")
 
     try:
-        metadata_size = decode_number(bps_patch)
+        metadata_size, pos = decode_number(buf, pos, end_cmd)
         logger.debug("Metadata size: 0x%x", metadata_size)
     except ValueError:
         raise ValueError("Failed to decode metadata size.")
 
-    if metadata_size + bps_patch.tell() > patch_end - 12:
+    if metadata_size + pos > end_cmd:
         raise ValueError("Metadata size too large.")
 
-    bps_patch.seek(metadata_size, 1)
+    return source_size, target_size, pos + metadata_size
 
-    source_position = 0
-    target_position = 0
-    outread_position = 0
 
-    while bps_patch.tell() < patch_end - 12:
-        bps_pos = bps_patch.tell()
-        data = decode_number(bps_patch)
-        command = data & 3
-        length = (data >> 2) + 1
-        error_details = """\
+def _error_details(bps_pos: int, command: int, length: int, source_position: int,
+                   target_position: int, offset_name: Optional[str] = None,
+                   relative_offset: Optional[int] = None) -> str:
+    """Describe the command that made a patch invalid.
+
+    This is only called once a command has failed validation, so that valid
+    commands don't pay for formatting.
+    """
+    details = """\
 Offset: 0x{:x}
 Command: {:d}
 Length: 0x{:x}
 Source position: 0x{:x}
 Target position: 0x{:x}""".format(
-            bps_pos, command, length, source_position, target_position)
-        # logger.debug("Decoded a command.\n%s", error_details)
+        bps_pos, command, length, source_position, target_position)
+    if offset_name:
+        details += "\n{}: {}".format(offset_name, relative_offset)
+    return details
+
+
+def _parse_stream(buf: bytes, pos: int, source_size: int,
+                  target_size: int) -> Tuple[List[int], List[int], List[int]]:
+    """Validate and decode the commands in ``buf``, starting at ``pos``.
+
+    Return three parallel lists: the command numbers, the lengths, and the
+    offsets to copy from (into the source for SourceRead and SourceCopy, into
+    ``buf`` for TargetRead, and into the target for TargetCopy). Consecutive
+    commands that copy a contiguous range of the source are merged into one.
+    Every command returned is known to stay within the bounds given by the
+    patch header. Raise a ``ValueError`` on the first invalid command.
+
+    :param buf: the contents of the patch file
+    :param pos: the offset of the first command in ``buf``
+    :param source_size: the size of the source, from the patch header
+    :param target_size: the size of the target, from the patch header
+    """
+    end_cmd = len(buf) - 12
+    commands = []
+    lengths = []
+    offsets = []
+    # Look these up once rather than on every command.
+    decode = decode_number
+    add_command = commands.append
+    add_length = lengths.append
+    add_offset = offsets.append
+
+    source_position = 0
+    target_position = 0
+    outread_position = 0
+    # The source offset just past the last entry, if that entry reads from
+    # the source, else -1.
+    source_run_end = -1
+
+    while pos < end_cmd:
+        bps_pos = pos
+        data, pos = decode(buf, pos, end_cmd)
+        command = data & 3
+        length = (data >> 2) + 1
         if command == 0:
             # SourceRead
-            target_position += length
-            if target_position > source_size:
+            offset = target_position
+            if target_position + length > source_size:
                 raise ValueError("Attempted to read beyond end of source.\n{}".format(
-                    error_details))
-            if target_position > target_size:
+                    _error_details(bps_pos, command, length, source_position, target_position)))
+            if target_position + length > target_size:
                 raise ValueError("Attempted to write beyond end of target.\n{}".format(
-                    error_details))
+                    _error_details(bps_pos, command, length, source_position, target_position)))
         elif command == 1:
             # TargetRead
-            target_position += length
-            if target_position > target_size:
+            offset = pos
+            if target_position + length > target_size:
                 raise ValueError("Attempted to write beyond end of target.\n{}".format(
-                    error_details))
-            bps_patch.seek(length, 1)
-            if bps_patch.tell() > patch_end - 12:
+                    _error_details(bps_pos, command, length, source_position, target_position)))
+            pos += length
+            if pos > end_cmd:
                 raise ValueError("TargetRead length too large.\n{}".format(
-                    error_details))
+                    _error_details(bps_pos, command, length, source_position, target_position)))
         elif command == 2:
             # SourceCopy
-            copy_data = decode_number(bps_patch)
-            source_relative_offset = (-1 if (copy_data & 1) else 1) * (copy_data >> 1)
-            error_details += "\nSRO: {}".format(source_relative_offset)
-            if source_position + source_relative_offset < 0:
+            copy_data, pos = decode(buf, pos, end_cmd)
+            source_relative_offset = (-(copy_data & 1) | 1) * (copy_data >> 1)
+            offset = source_position + source_relative_offset
+            if offset < 0:
                 raise ValueError("Attempted to read beyond beginning of source.\n{}".format(
-                    error_details))
-            source_position += source_relative_offset + length
-            if source_position > source_size:
+                    _error_details(bps_pos, command, length, source_position, target_position,
+                                   "SRO", source_relative_offset)))
+            if offset + length > source_size:
                 raise ValueError("Attempted to read beyond end of source.\n{}".format(
-                    error_details))
-            target_position += length
-            if target_position > target_size:
+                    _error_details(bps_pos, command, length, source_position, target_position,
+                                   "SRO", source_relative_offset)))
+            if target_position + length > target_size:
                 raise ValueError("Attempted to write beyond end of target.\n{}".format(
-                    error_details))
-        elif command == 3:
+                    _error_details(bps_pos, command, length, source_position, target_position,
+                                   "SRO", source_relative_offset)))
+            source_position = offset + length
+        else:
             # TargetCopy
-            copy_data = decode_number(bps_patch)
-            target_relative_offset = (-1 if (copy_data & 1) else 1) * (copy_data >> 1)
-            outread_position += target_relative_offset
-            error_details += "\nTRO: {}".format(target_relative_offset)
-            if outread_position < 0:
+            copy_data, pos = decode(buf, pos, end_cmd)
+            target_relative_offset = (-(copy_data & 1) | 1) * (copy_data >> 1)
+            offset = outread_position + target_relative_offset
+            if offset < 0:
                 raise ValueError("Attempted to read beyond beginning of target.\n{}".format(
-                    error_details))
-            if outread_position >= target_position:
+                    _error_details(bps_pos, command, length, source_position, target_position,
+                                   "TRO", target_relative_offset)))
+            if offset >= target_position:
                 raise ValueError("Attempted to read beyond end of target.\n{}".format(
-                    error_details))
-            target_position += length
-            if target_position > target_size:
+                    _error_details(bps_pos, command, length, source_position, target_position,
+                                   "TRO", target_relative_offset)))
+            if target_position + length > target_size:
                 raise ValueError("Attempted to write beyond end of target.\n{}".format(
-                    error_details))
-            outread_position += length
+                    _error_details(bps_pos, command, length, source_position, target_position,
+                                   "TRO", target_relative_offset)))
+            outread_position = offset + length
+        target_position += length
+        if command & 1:
+            add_command(command)
+            add_length(length)
+            add_offset(offset)
+            source_run_end = -1
+        elif offset == source_run_end:
+            # A SourceRead or SourceCopy that carries on from where the last
+            # one left off joins it in a single copy.
+            lengths[-1] += length
+            source_run_end += length
+        else:
+            add_command(command)
+            add_length(length)
+            add_offset(offset)
+            source_run_end = offset + length
 
     if target_position != target_size:
         raise ValueError("Final patch size incorrect. Expected: {}. Actual: {}".format(
             target_size, target_position))
 
+    return commands, lengths, offsets
+
+
+def validate_patch(bps_patch: BinaryIO):
+    """Verify that ``bps_patch`` is a valid BPS patch.
+
+    If the patch is valid, return. If the patch is invalid, raise a
+    ``ValueError`` describing the problem.
+
+    :param bps_patch: the patch file
+    """
+    bps_patch.seek(0)
+    buf = bps_patch.read()
+    source_size, target_size, pos = _read_header(buf)
+    _parse_stream(buf, pos, source_size, target_size)
+
 
 def validate_checksum(source: BinaryIO, bps_patch: BinaryIO):
     """Ensure that the source file matches the checksum in the patch.
@@ -192,13 +286,47 @@ def validate_checksum(source: BinaryIO, bps_patch: BinaryIO):
     bps_patch.seek(-12, 2)
     checksum = int.from_bytes(bps_patch.read(4), byteorder='little')
     source.seek(0)
-    calculated_checksum = zlib.crc32(source.read())
+    calculated_checksum = crc32(source)
     if calculated_checksum != checksum:
         raise ValueError("Incompatible source. Stored checksum {:X}, actual checksum {:X}.".format(
             checksum, calculated_checksum))
     source.seek(0)
 
 
+def _execute(commands: List[int], lengths: List[int], offsets: List[int],
+             buf: bytes, src: Union[bytes, mmap.mmap], out: memoryview):
+    """Apply commands decoded by ``_parse_stream`` to ``out``.
+
+    ``src`` and ``out`` must be exactly the sizes the commands were validated
+    against.
+
+    :param commands: the command numbers
+    :param lengths: the command lengths
+    :param offsets: the offsets to copy from
+    :param buf: the contents of the patch file
+    :param src: the contents of the source file
+    :param out: the buffer to write the patched file to
+    """
+    # Every command but an overlapping TargetCopy is a single slice copy from
+    # one of these, indexed by command number.
+    sources = (src, buf, src, out)
+    target_position = 0
+
+    for command, length, offset in zip(commands, lengths, offsets):
+        write_end = target_position + length
+        read_end = offset + length
+        if command != 3 or read_end <= target_position:
+            out[target_position:write_end] = sources[command][offset:read_end]
+        else:
+            # TargetCopy overlapping the bytes being written: the bytes
+            # between the read and write positions repeat until the copy is
+            # done.
+            pattern = bytes(out[offset:target_position])
+            repeats = -(-length // len(pattern))
+            out[target_position:write_end] = memoryview(pattern * repeats)[:length]
+        target_position = write_end
+
+
 def patch(source: BinaryIO, bps_patch: BinaryIO) -> BinaryIO:
     """Return the patched source.
 
@@ -206,63 +334,44 @@ def patch(source: BinaryIO, bps_patch: BinaryIO) -> BinaryIO:
     :param bps_patch: the patch file
     """
     bps_patch.seek(0)
-    validate_patch(bps_patch)
-
-    validate_checksum(source, bps_patch)
-
-    patch_end = bps_patch.seek(0, 2)
-    bps_patch.seek(4)
-    source_size = decode_number(bps_patch)  # noqa: F841
-    target_size = decode_number(bps_patch)  # noqa: F841
-    metadata_size = decode_number(bps_patch)
-    bps_patch.seek(metadata_size, 1)
+    buf = bps_patch.read()
+    source_size, target_size, pos = _read_header(buf)
+    commands, lengths, offsets = _parse_stream(buf, pos, source_size, target_size)
 
-    outread_position = 0
+    # Write the target straight into the buffer of the BytesIO that is
+    # returned, rather than building it elsewhere and copying it in.
     output = BytesIO()
-
-    while bps_patch.tell() < patch_end - 12:
-        data = decode_number(bps_patch)
-        command = data & 3
-        length = (data >> 2) + 1
-        if command == 0:
-            # SourceRead
-            old_source_position = source.tell()
-            source.seek(output.tell())
-            copy_bytes(source, output, length)
-            source.seek(old_source_position)
-        elif command == 1:
-            # TargetRead
-            copy_bytes(bps_patch, output, length)
-        elif command == 2:
-            # SourceCopy
-            copy_data = decode_number(bps_patch)
-            source_relative_offset = (-1 if (copy_data & 1) else 1) * (copy_data >> 1)
-            source.seek(source_relative_offset, 1)
-            copy_bytes(source, output, length)
-        elif command == 3:
-            # TargetCopy
-            copy_data = decode_number(bps_patch)
-            target_relative_offset = (-1 if (copy_data & 1) else 1) * (copy_data >> 1)
-            outread_position += target_relative_offset
-            to_go = length
-            while to_go > 0:
-                step = min(output.tell() - outread_position, 2**8)
-                output.seek(outread_position)
-                segment = output.read(min(to_go, step))
-                outread_position = output.tell()
-                output.seek(0, 2)
-                output.write(segment)
-                to_go -= step
-
-    bps_patch.seek(-8, 2)
-    checksum = int.from_bytes(bps_patch.read(4), byteorder='little')
+    if target_size:
+        output.seek(target_size - 1)
+        output.write(b'\0')
     output.seek(0)
-    calculated_checksum = zlib.crc32(output.read())
-    if calculated_checksum == checksum:
-        logger.debug("Patch applied successfully.")
-    else:
-        raise ValueError("Invalid checksum. Stored checksum {:X}, actual checksum {:X}.".format(
-            checksum, calculated_checksum))
 
-    output.seek(0)
+    with output.getbuffer() as out:
+        with mapped(source) as src:
+            if len(src) != source_size:
+                raise ValueError(
+                    "Incompatible source. Expected size 0x{:x}, actual size 0x{:x}.".format(
+                        source_size, len(src)))
+
+            # Both zlib and fastcrc release the GIL while checksumming, so
+            # the source can be checked while the patch is applied.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                source_checksum = executor.submit(crc32_bytes, src)
+                _execute(commands, lengths, offsets, buf, src, out)
+
+        checksum = int.from_bytes(buf[-12:-8], byteorder='little')
+        calculated_checksum = source_checksum.result()
+        if calculated_checksum != checksum:
+            raise ValueError(
+                "Incompatible source. Stored checksum {:X}, actual checksum {:X}.".format(
+                    checksum, calculated_checksum))
+
+        checksum = int.from_bytes(buf[-8:-4], byteorder='little')
+        calculated_checksum = crc32_bytes(out)
+        if calculated_checksum == checksum:
+            logger.debug("Patch applied successfully.")
+        else:
+            raise ValueError("Invalid checksum. Stored checksum {:X}, actual checksum {:X}.".format(
+                checksum, calculated_checksum))
+
     return output
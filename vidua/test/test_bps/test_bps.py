@@ -1,9 +1,25 @@
+import gzip
 import os
+import tempfile
+import zlib
+from io import BytesIO
 
 import pytest
 
 from vidua import bps
 
+try:
+    from vidua import _bps_fast
+except ImportError:
+    _bps_fast = None
+
+decoders = [
+    bps._decode_number_py,
+    pytest.param(getattr(_bps_fast, 'decode_number', None),
+                 marks=pytest.mark.skipif(_bps_fast is None,
+                                          reason="compiled extension not built")),
+]
+
 BASE_PATH = os.path.dirname(os.path.realpath(__file__))
 
 valid_test_files = [
@@ -110,3 +126,183 @@ def test_validate_source_read_beyond_end():
         with pytest.raises(ValueError) as excinfo:
             bps.validate_patch(patch)
         assert str(excinfo.value).startswith('Attempted to read beyond end of source.')
+
+
+@pytest.mark.parametrize("encoded,value", [
+    (b'\x80', 0),
+    (b'\x81', 1),
+    (b'\xff', 0x7f),
+    (b'\x00\x80', 0x80),
+    (b'\x7f\x80', 0xff),
+    (b'\x00\x00\x80', 0x4080),
+    (bytes(8) + b'\x80', sum(1 << (7 * k) for k in range(1, 9))),
+    (bytes(9) + b'\x80', sum(1 << (7 * k) for k in range(1, 10))),
+    (b'\x7f' * 9 + b'\xff', sum(1 << (7 * k) for k in range(1, 11)) - 1),
+])
+@pytest.mark.parametrize("decode_number", decoders)
+def test_decode_number(decode_number, encoded, value):
+    buf = b'BPS1' + encoded + bytes(12)
+    assert decode_number(buf, 4, len(buf) - 12) == (value, 4 + len(encoded))
+
+
+@pytest.mark.parametrize("decode_number", decoders)
+def test_decode_number_truncated(decode_number):
+    with pytest.raises(ValueError) as excinfo:
+        decode_number(b'BPS1' + bytes(13), 4, 5)
+    assert str(excinfo.value) == 'Invalid number encoding.'
+
+
+@pytest.mark.parametrize("decode_number", decoders)
+def test_decode_number_too_long(decode_number):
+    with pytest.raises(ValueError) as excinfo:
+        decode_number(b'BPS1' + bytes(10) + b'\x80' + bytes(12), 4, 15)
+    assert str(excinfo.value) == 'Invalid number encoding.'
+    with pytest.raises(ValueError) as excinfo:
+        decode_number(b'BPS1' + bytes(9) + b'\x00' + bytes(12), 4, 15)
+    assert str(excinfo.value) == 'Invalid number encoding.'
+
+
+def encode_number(number):
+    encoded = bytearray()
+    while True:
+        x = number & 0x7f
+        number >>= 7
+        if number == 0:
+            encoded.append(0x80 | x)
+            return bytes(encoded)
+        encoded.append(x)
+        number -= 1
+
+
+def make_patch(source, target, commands):
+    body = (b'BPS1' + encode_number(len(source)) + encode_number(len(target))
+            + encode_number(0) + commands
+            + zlib.crc32(source).to_bytes(4, 'little')
+            + zlib.crc32(target).to_bytes(4, 'little'))
+    return BytesIO(body + zlib.crc32(body).to_bytes(4, 'little'))
+
+
+def test_apply_overlapping_target_copy():
+    source = b'xyz'
+    target = b'ab' + b'ab' * 10 + b'z'
+    commands = (
+        # TargetRead 'ab'
+        encode_number(((2 - 1) << 2) | 1) + b'ab'
+        # TargetCopy 20 bytes from the start of the target
+        + encode_number(((20 - 1) << 2) | 3) + encode_number(0)
+        # SourceCopy 'z'
+        + encode_number(((1 - 1) << 2) | 2) + encode_number(2 << 1)
+    )
+    bps_patch = make_patch(source, target, commands)
+    bps.validate_patch(bps_patch)
+    assert bps.patch(BytesIO(source), bps_patch).read() == target
+
+
+def test_apply_run_length_target_copy():
+    source = b'x'
+    target = b'a' * 1000
+    commands = (
+        encode_number(((1 - 1) << 2) | 1) + b'a'
+        + encode_number(((999 - 1) << 2) | 3) + encode_number(0)
+    )
+    bps_patch = make_patch(source, target, commands)
+    assert bps.patch(BytesIO(source), bps_patch).read() == target
+
+
+def test_apply_invalid_command():
+    source = b'xyz'
+    target = b'xyzw'
+    commands = encode_number(((4 - 1) << 2) | 0)
+    bps_patch = make_patch(source, target, commands)
+    with pytest.raises(ValueError) as excinfo:
+        bps.patch(BytesIO(source), bps_patch)
+    assert str(excinfo.value).startswith('Attempted to read beyond end of source.')
+
+
+def test_apply_incompatible_source_same_size():
+    with open(os.path.join(BASE_PATH, 'test_a.bps'), 'rb') as patch:
+        with open(os.path.join(BASE_PATH, 'test_a_original.txt'), 'rb') as original:
+            source = bytearray(original.read())
+        source[0] ^= 0xff
+        with pytest.raises(ValueError) as excinfo:
+            bps.patch(BytesIO(source), patch)
+        assert str(excinfo.value).startswith('Incompatible source. Stored checksum')
+
+
+def test_apply_merged_source_copies():
+    source = bytes(range(32))
+    target = source[:24] + b'!' + source[4:12]
+    commands = (
+        # SourceRead 8, SourceRead 8, then SourceCopy 8 carrying on from there
+        encode_number(((8 - 1) << 2) | 0)
+        + encode_number(((8 - 1) << 2) | 0)
+        + encode_number(((8 - 1) << 2) | 2) + encode_number(16 << 1)
+        # TargetRead '!', then SourceCopy 8 from offset 4
+        + encode_number(((1 - 1) << 2) | 1) + b'!'
+        + encode_number(((8 - 1) << 2) | 2) + encode_number((20 << 1) | 1)
+    )
+    bps_patch = make_patch(source, target, commands)
+    assert bps.patch(BytesIO(source), bps_patch).read() == target
+    buf = bps_patch.getvalue()
+    source_size, target_size, pos = bps._read_header(buf)
+    commands, lengths, offsets = bps._parse_stream(buf, pos, source_size, target_size)
+    assert commands == [0, 1, 2]
+    assert lengths == [24, 1, 8]
+    assert offsets[0] == 0 and offsets[2] == 4
+
+
+def test_apply_unflushed_source():
+    source = bytes(range(256)) * 390 + bytes(160)
+    target = b'!' + source[1:]
+    commands = (encode_number(((1 - 1) << 2) | 1) + b'!'
+                + encode_number(((len(source) - 2) << 2) | 2) + encode_number(1 << 1))
+    bps_patch = make_patch(source, target, commands)
+    with tempfile.TemporaryFile() as source_file:
+        for i in range(0, len(source), 1000):
+            source_file.write(source[i:i + 1000])
+        assert bps.patch(source_file, bps_patch).read() == target
+
+
+def test_apply_gzip_source():
+    bps_path, original_path, modded_path = valid_test_files[0]
+    with open(original_path, 'rb') as original, open(modded_path, 'rb') as modded:
+        source, target = original.read(), modded.read()
+    with tempfile.TemporaryDirectory() as d:
+        gzip_path = os.path.join(d, 'original.gz')
+        with gzip.open(gzip_path, 'wb') as gzip_file:
+            gzip_file.write(source)
+        with open(bps_path, 'rb') as patch, gzip.open(gzip_path, 'rb') as gzip_file:
+            assert bps.patch(gzip_file, patch).read() == target
+
+
+class ReadOnlyStream:
+    """A stream with nothing but read, seek and tell."""
+
+    def __init__(self, data):
+        self._buffer = BytesIO(data)
+
+    def read(self, size=-1):
+        return self._buffer.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._buffer.seek(offset, whence)
+
+    def tell(self):
+        return self._buffer.tell()
+
+
+def test_apply_source_without_fileno():
+    bps_path, original_path, modded_path = valid_test_files[0]
+    with open(original_path, 'rb') as original, open(modded_path, 'rb') as modded:
+        source, target = original.read(), modded.read()
+    with open(bps_path, 'rb') as patch:
+        assert bps.patch(ReadOnlyStream(source), patch).read() == target
+
+
+def test_apply_wrong_source_size():
+    with open(os.path.join(BASE_PATH, 'test_a.bps'), 'rb') as patch:
+        with open(os.path.join(BASE_PATH, 'test_a_original.txt'), 'rb') as original:
+            source = original.read() + b'\0'
+        with pytest.raises(ValueError) as excinfo:
+            bps.patch(BytesIO(source), patch)
+        assert str(excinfo.value) == 'Incompatible source. Expected size 0x25, actual size 0x26.'
@@ -0,0 +1,11 @@
+from io import BytesIO
+
+import pytest
+
+from vidua.util import copy_bytes
+
+
+def test_copy_bytes_short_input():
+    with pytest.raises(ValueError) as excinfo:
+        copy_bytes(BytesIO(b'abc'), BytesIO(), 4)
+    assert str(excinfo.value) == 'Unexpected end of input.'
@@ -1,5 +1,14 @@
+import io
+import mmap
+from contextlib import contextmanager
 from enum import Enum
-from typing import BinaryIO
+from typing import BinaryIO, Iterator, Union
+
+try:
+    # The same CRC-32 as zlib's, but several times faster on large inputs.
+    from fastcrc.crc32 import iso_hdlc as crc32_bytes
+except ImportError:
+    from zlib import crc32 as crc32_bytes
 
 
 class PatchType(Enum):
@@ -24,10 +33,59 @@ def identify(patch: BinaryIO):
 def copy_bytes(from_buffer: BinaryIO, to_buffer: BinaryIO, length: int, size: int = 2**8):
     """Copy bytes from one buffer to another.
 
+    Raise a ``ValueError`` if ``from_buffer`` runs out before ``length`` bytes
+    have been copied.
+
     :param from_buffer: the source buffer
     :param to_buffer: the destination buffer
     :param length: the total number of bytes to copy
     :param size: the number of bytes to copy at once
     """
     while length > 0:
-        length -= to_buffer.write(from_buffer.read(min(length, size)))
+        chunk = from_buffer.read(min(length, size))
+        if not chunk:
+            raise ValueError("Unexpected end of input.")
+        length -= to_buffer.write(chunk)
+
+
+def crc32(buffer: BinaryIO, size: int = 2**20) -> int:
+    """Return the CRC-32 of the rest of a buffer.
+
+    The buffer is read in chunks, so the whole file is never held in memory.
+
+    :param buffer: the buffer to checksum
+    :param size: the number of bytes to read at once
+    """
+    checksum = 0
+    while True:
+        chunk = buffer.read(size)
+        if not chunk:
+            return checksum
+        checksum = crc32_bytes(chunk, checksum)
+
+
+@contextmanager
+def mapped(buffer: BinaryIO) -> Iterator[Union[bytes, mmap.mmap]]:
+    """Provide the whole contents of a buffer.
+
+    Files on disk are memory-mapped, so only the parts that are used are read.
+    Anything else (``BytesIO``, ``gzip`` and ``tarfile`` streams, and so on),
+    and empty files, are read into memory.
+
+    :param buffer: the buffer to read
+    """
+    raw = buffer.raw if isinstance(buffer, (io.BufferedReader, io.BufferedRandom)) else buffer
+    if isinstance(raw, io.FileIO):
+        # Anything still sitting in the file object's write buffer isn't in
+        # the file yet, so the mapping wouldn't see it.
+        buffer.flush()
+        try:
+            mapping = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass
+        else:
+            with mapping:
+                yield mapping
+            return
+    buffer.seek(0)
+    yield buffer.read()